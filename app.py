@@ -1,40 +1,84 @@
 import os
-import json
+import re
+import orjson
+import asyncio
 import logging
+import threading
+import shutil
+import gzip
+import tempfile
+import time
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 import hashlib
-from fastapi import FastAPI, BackgroundTasks, HTTPException
-from fastapi.responses import JSONResponse, HTMLResponse
+from cachetools import LRUCache, TTLCache, cached
+from cachetools.keys import hashkey
+from fastapi import FastAPI, BackgroundTasks, HTTPException, Request
+from fastapi.responses import JSONResponse, HTMLResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import os
 from pydub.utils import which
 from pydub import AudioSegment
 from dotenv import load_dotenv
-from google import genai
+from google.genai import types
 import google.auth
 import google.auth.transport.requests
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 
 # Load environment variables from .env file if present
 load_dotenv(override=True)
 
 
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 YOUTUBE_API_KEY = os.getenv("YOUTUBE_API_KEY")
-client = genai.Client(api_key=GEMINI_API_KEY)
 
-os.environ["PATH"] += os.pathsep + "/usr/bin"
-AudioSegment.converter = which("ffmpeg")
+# Pooled HTTP session for YouTube and other googleapis.com GET calls so repeat
+# requests reuse the TCP/TLS connection. Retry only covers idempotent methods,
+# so a failed lookup is simply asked again.
+http_session = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=50,
+    max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504]),
+)
+http_session.mount("https://", _adapter)
+http_session.mount("http://", _adapter)
+
+# Async HTTP/2 client for calls made from the event loop (the Cloud Run
+# trigger). The worker never uses it, so the blocking session above stays
+# for helpers it shares with the API.
+async_http = httpx.AsyncClient(
+    http2=True,
+    timeout=10.0,
+    limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+)
+
+if "/usr/bin" not in os.environ.get("PATH", "").split(os.pathsep):
+    os.environ["PATH"] += os.pathsep + "/usr/bin"
+# Resolve ffmpeg once; FFMPEG_BIN skips the PATH search entirely.
+FFMPEG_BIN = os.getenv("FFMPEG_BIN") or which("ffmpeg") or "/usr/bin/ffmpeg"
+AudioSegment.converter = FFMPEG_BIN
+AudioSegment.ffmpeg = FFMPEG_BIN
+AudioSegment.ffprobe = os.path.join(os.path.dirname(FFMPEG_BIN), "ffprobe")
 stage = "test"
 
 # Import your pipeline functions from gen.py
+# gen.py's Gemini client is shared so reference lookups and generation
+# reuse one connection pool instead of each opening their own.
 from gen import (
+    get_gemini_client,
+    build_kb_block,
     generate_outline,
     generate_code,
+    remember_rendered_code,
     write_temp,
     render_voiceover_scene,
+    scene_class_name,
 )
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -44,6 +88,28 @@ S3_BUCKET = os.getenv("S3_BUCKET")  # e.g., "compre_gen"
 if not S3_BUCKET:
     raise Exception("S3_BUCKET environment variable must be configured.")
 
+# One client for the whole process: construction is expensive and the client
+# keeps a keep-alive connection pool, so polls reuse warm connections to S3.
+s3_client = boto3.client(
+    "s3",
+    config=Config(
+        max_pool_connections=50,
+        connect_timeout=30,
+        read_timeout=300,
+        retries={"max_attempts": 10, "mode": "adaptive"},
+        # Keep pooled sockets alive through the long idle gap between the
+        # worker's prompt download and its uploads after the render
+        tcp_keepalive=True,
+    ),
+)
+# Rendered videos are tens of MB: upload them as parallel 16 MB parts
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=10,
+    use_threads=True,
+)
+
 # Create FastAPI app instance.
 # Using the stage name as part of the root path (optional)
 app = FastAPI(root_path=f"/{stage}" if stage else "")
@@ -57,6 +123,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("shutdown")
+async def close_http_clients():
+    await async_http.aclose()
+
 ###############################################################################
 # Data Models for Incoming Requests
 ###############################################################################
@@ -69,44 +139,107 @@ class MCQReviewRequest(BaseModel):
     selected_option: str
     expected_answer: str
 
+###############################################################################
+# Prompt Templates
+###############################################################################
+# The rendered prompt is hashed into the video key, so any change to this
+# wording invalidates every cached video.
+VIDEO_PROMPT_TEMPLATE = (
+    "Here's a question: \"{question}\".\n"
+    "The user answered: \"{user_answer}\".\n\n"
+    "Generate a short explanatory video script that:\n"
+    "1️⃣ Explains the expected answer in detail.\n"
+    "2️⃣ Points out where the user's answer is missing or incorrect.\n"
+    "3️⃣ Provides clear guidance on how to improve."
+)
+
+MCQ_PROMPT_TEMPLATE = (
+    "Here's a multiple-choice question: \"{question}\".\n"
+    "The user selected answer: \"{selected_option}\".\n"
+    "The correct answer is: \"{expected_answer}\".\n\n"
+    "Generate a short explanatory video script that:\n"
+    "1️⃣ Explains why the correct answer is right.\n"
+    "2️⃣ If the user's answer is wrong, explains the misconception or error.\n"
+    "3️⃣ Provides key concepts to remember for similar questions."
+)
+
+def video_title(question: str) -> str:
+    return f"Explanation: {question[:50]}{'...' if len(question) > 50 else ''}"
+
+
+# Application-default credentials are resolved once and their access token is
+# reused until it expires (~1h), instead of an OAuth exchange per trigger.
+# Resolved lazily so importing this module (e.g. from the worker) needs no
+# Google credentials.
+_credentials = None
+_credentials_lock = threading.Lock()
+_auth_request = google.auth.transport.requests.Request(session=http_session)
+
+def get_access_token() -> str:
+    global _credentials
+    with _credentials_lock:
+        if _credentials is None:
+            _credentials, _ = google.auth.default(
+                scopes=["https://www.googleapis.com/auth/cloud-platform"]
+            )
+        if not _credentials.valid:
+            _credentials.refresh(_auth_request)
+        return _credentials.token
+
+
+# The worker job is fixed per deployment, so its endpoint is built once.
+CLOUD_RUN_JOB = os.getenv("CLOUD_RUN_JOB", "my-worker-job")
+CLOUD_RUN_REGION = os.getenv("CLOUD_RUN_REGION", "us-central1")
+CLOUD_RUN_PROJECT = os.getenv("CLOUD_RUN_PROJECT", "gen-lang-client-0755469978")
+CLOUD_RUN_URL = (
+    f"https://run.googleapis.com/v2/projects/{CLOUD_RUN_PROJECT}"
+    f"/locations/{CLOUD_RUN_REGION}/jobs/{CLOUD_RUN_JOB}:run"
+)
+# Prompts up to this many UTF-8 bytes go to the worker in its PROMPT env var
+# rather than through S3; well under Cloud Run's 32 KiB per-variable limit.
+INLINE_PROMPT_LIMIT = 4096
 
-def trigger_cloud_run_job(job_name, region, project_id, prompt):
-    s3_client = boto3.client("s3")
+def upload_prompt_to_s3(prompt: str) -> str:
+    """
+    Store prompt where the worker job can read it and return its S3 key.
+    """
     prompt_key = f"prompts/{generate_video_key(prompt)}.txt"
     print(f"Uploading prompt to s3://{S3_BUCKET}/{prompt_key}")
     s3_client.put_object(
         Bucket=S3_BUCKET,
         Key=prompt_key,
-        Body=prompt.encode("utf-8"),
-        ContentType="text/plain"
+        # The prompt boilerplate compresses well; worker.py inflates it
+        Body=gzip.compress(prompt.encode("utf-8"), compresslevel=6),
+        ContentType="text/plain",
+        ContentEncoding="gzip",
     )
-    try:
-        s3_client.head_object(Bucket=S3_BUCKET, Key=prompt_key)
-        print(f"Prompt verified at s3://{S3_BUCKET}/{prompt_key}")
-    except s3_client.exceptions.ClientError as e:
-        print(f"Failed to verify prompt at s3://{S3_BUCKET}/{prompt_key}: {e}")
-        raise
-
-    credentials, _ = google.auth.default()
-    credentials.refresh(google.auth.transport.requests.Request())
-    token = credentials.token
-
-    url = f"https://run.googleapis.com/v2/projects/{project_id}/locations/{region}/jobs/{job_name}:run"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
-    body = {
-        "overrides": {
-            "containerOverrides": [
-                {
-                    "args": [prompt_key],
-                }
-            ]
-        }
-    }
+    return prompt_key
 
-    resp = requests.post(url, headers=headers, json=body)
+async def trigger_cloud_run_job(prompt, refs=None):
+    """
+    Start the worker job for prompt. refs, the reference links already
+    returned to the client, is passed along so the worker doesn't look
+    them up a second time.
+    """
+    override = {}
+    if len(prompt.encode("utf-8")) <= INLINE_PROMPT_LIMIT:
+        # Small prompts skip the S3 put here and the get in the worker;
+        # the worker ignores the key argument when PROMPT is set.
+        override["env"] = [{"name": "PROMPT", "value": prompt}]
+        prompt_key = "-"
+    else:
+        prompt_key = await asyncio.to_thread(upload_prompt_to_s3, prompt)
+    # A refresh is a blocking OAuth round-trip, roughly once an hour
+    token = await asyncio.to_thread(get_access_token)
+
+    args = [prompt_key]
+    if refs is not None:
+        args.append(orjson.dumps(refs).decode("utf-8"))
+    override["args"] = args
+    headers = {"Authorization": f"Bearer {token}"}
+    body = {"overrides": {"containerOverrides": [override]}}
+
+    resp = await async_http.post(CLOUD_RUN_URL, headers=headers, json=body)
     if resp.status_code == 200:
         print("Cloud Run Job triggered successfully")
     else:
@@ -130,182 +263,349 @@ def upload_file_to_s3(local_path: str, s3_key: str) -> str:
     Upload the file at local_path to the S3 bucket using s3_key.
     Returns the public URL of the uploaded file.    
     """
-    s3_client = boto3.client("s3")
-    s3_client.upload_file(local_path, S3_BUCKET, s3_key)
+    s3_client.upload_file(
+        local_path,
+        S3_BUCKET,
+        s3_key,
+        Config=TRANSFER_CONFIG,
+        # Keys are content hashes, so an uploaded video never changes
+        ExtraArgs={
+            "ContentType": "video/mp4",
+            "CacheControl": "public, max-age=31536000, immutable",
+        },
+    )
     public_url = f"https://{S3_BUCKET}.s3.amazonaws.com/{s3_key}"
     return public_url
 
+def get_existing_video_url(s3_key: str):
+    """
+    Return the public URL of an already uploaded video, or None if s3_key
+    doesn't exist yet.
+    """
+    try:
+        s3_client.head_object(Bucket=S3_BUCKET, Key=s3_key)
+    except s3_client.exceptions.ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            logging.warning("Error checking S3 for existing video %s: %s", s3_key, e)
+        return None
+    return f"https://{S3_BUCKET}.s3.amazonaws.com/{s3_key}"
+
+def read_result(video_key: str) -> bytes:
+    """
+    Return the gzip-compressed JSON the worker stored for video_key.
+    Results written before the worker compressed them are compressed here,
+    so callers always get gzip bytes.
+    """
+    obj = s3_client.get_object(Bucket=S3_BUCKET, Key=f"{video_key}.json")
+    body = obj["Body"].read()
+    if obj.get("ContentEncoding") != "gzip":
+        body = gzip.compress(body, compresslevel=6)
+    return body
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """
+    Whether an Accept-Encoding header allows gzip. An explicit gzip entry
+    wins over "*", and q=0 means the coding is refused.
+    """
+    wildcard = False
+    for entry in accept_encoding.split(","):
+        coding, *params = (part.strip() for part in entry.split(";"))
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        coding = coding.lower()
+        if coding in ("gzip", "x-gzip"):
+            return q > 0
+        if coding == "*":
+            wildcard = q > 0
+    return wildcard
+
+def result_response(gz_body: bytes, request: Request) -> Response:
+    """
+    Send a stored result as-is to clients that accept gzip, inflated otherwise.
+    """
+    if accepts_gzip(request.headers.get("accept-encoding", "")):
+        return Response(
+            content=gz_body,
+            media_type="application/json",
+            status_code=200,
+            headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"},
+        )
+    return Response(content=gzip.decompress(gz_body), media_type="application/json", status_code=200)
+
+def get_existing_response(video_key: str):
+    """
+    Return the gzip-compressed JSON the worker stored for video_key, or None
+    if the video has not been generated yet.
+    """
+    try:
+        return read_result(video_key)
+    except s3_client.exceptions.ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            # Some other S3 error
+            logging.error("Error checking S3 for existing JSON: %s", e)
+            raise HTTPException(status_code=500, detail="Error checking cache")
+    return None
+
+# video_key -> time.monotonic() at which its Cloud Run job was started.
+# Lets duplicate submissions share the job already in flight instead of
+# starting another render of the same prompt.
+_inflight_jobs = {}
+# A job execution can run its task once plus --max-retries more times, each up
+# to --task-timeout seconds; keep these in sync with the job's deployment.
+CLOUD_RUN_TASK_TIMEOUT = int(os.getenv("CLOUD_RUN_TASK_TIMEOUT", "600"))
+CLOUD_RUN_MAX_RETRIES = int(os.getenv("CLOUD_RUN_MAX_RETRIES", "3"))
+INFLIGHT_TTL = CLOUD_RUN_TASK_TIMEOUT * (CLOUD_RUN_MAX_RETRIES + 1)  # seconds
+
+def claim_job(video_key: str) -> bool:
+    """
+    Mark a Cloud Run job for video_key as started.
+    Returns False if one was already started within the last INFLIGHT_TTL seconds.
+    """
+    now = time.monotonic()
+    started = _inflight_jobs.get(video_key)
+    if started is not None and now - started < INFLIGHT_TTL:
+        return False
+    if len(_inflight_jobs) > 1024:
+        for key, ts in list(_inflight_jobs.items()):
+            if now - ts >= INFLIGHT_TTL:
+                del _inflight_jobs[key]
+    _inflight_jobs[video_key] = now
+    return True
+
+async def start_job(video_key: str, prompt: str, refs: dict = None) -> None:
+    """
+    Start the worker job for prompt off the event loop.
+    Identical submissions made while a render is running share that job.
+    """
+    if not claim_job(video_key):
+        return
+    try:
+        await trigger_cloud_run_job(prompt, refs)
+    except Exception:
+        _inflight_jobs.pop(video_key, None)
+        raise
+
 ###############################################################################
 # Helper Functions for Reference Retrieval (unchanged)
 ###############################################################################
+# Reference lookups are cached per question for an hour so repeats skip the
+# network, while links that disappear from YouTube/the web eventually age out.
+REFERENCE_CACHE_TTL = 3600
+
+def reference_cache_key(query: str, n: int):
+    """
+    Cache key for a reference lookup. Case and whitespace differences
+    between otherwise identical questions share one entry.
+    """
+    return hashkey(" ".join(query.split()).casefold(), n)
+
+YOUTUBE_SEARCH_URL = "https://www.googleapis.com/youtube/v3/search"
+
+@cached(
+    TTLCache(maxsize=4096, ttl=REFERENCE_CACHE_TTL),
+    key=reference_cache_key,
+    lock=threading.Lock(),
+)
+def _search_youtube(search_query: str, n: int) -> tuple:
+    """
+    Query the YouTube Data API and return (title, url) pairs.
+    Cached per query; errors propagate so failures are never cached.
+    """
+    response = http_session.get(
+        YOUTUBE_SEARCH_URL,
+        params={
+            "part": "snippet",
+            "maxResults": n,
+            "q": search_query,
+            "key": YOUTUBE_API_KEY,
+            "type": "video",
+            # Only the fields used below; drops descriptions and thumbnails
+            "fields": "items(id/videoId,snippet/title)",
+        },
+        timeout=5,
+    )
+    response.raise_for_status()
+    data = orjson.loads(response.content)
+    results = [
+        (item["snippet"]["title"], f"https://www.youtube.com/watch?v={item['id']['videoId']}")
+        for item in data.get("items", ())
+        if item["id"].get("videoId")
+    ]
+
+    return tuple(results)
+
 def get_youtube_references(prompt: str, n: int = 3) -> list:
     """
     Use the YouTube Data API to fetch relevant videos for the given prompt.
     Returns a list of dicts with 'title' and 'url'.
     """
-    search_query = prompt
-    url = (
-        f"https://www.googleapis.com/youtube/v3/search"
-        f"?part=snippet&maxResults={n}&q={requests.utils.quote(search_query)}"
-        f"&key={YOUTUBE_API_KEY}&type=video"
-    )
-
     try:
-        response = requests.get(url)
-        response.raise_for_status()
-        data = response.json()
-        results = []
-
-        for item in data.get("items", []):
-            video_id = item["id"].get("videoId")
-            title = item["snippet"]["title"]
-            if video_id:
-                video_url = f"https://www.youtube.com/watch?v={video_id}"
-                results.append({"title": title, "url": video_url})
-
-        return results
+        return [{"title": title, "url": url} for title, url in _search_youtube(prompt, n)]
     except Exception as e:
         logging.error("Error fetching YouTube videos: %s", e)
         return [{"title": "No videos found", "url": ""}]
 
-def get_article_references(prompt: str, n: int = 2) -> list:
-    article_prompt = (
-        f"Provide {n} educational article or resource URLs that best explains the topic in: {prompt}. "
+# The fixed instructions travel as a system instruction built once, so each
+# call only sends the topic. (Too short for Gemini's explicit context cache.)
+ARTICLE_CONFIG = types.GenerateContentConfig(
+    system_instruction=(
+        "Provide the requested number of educational article or resource URLs that best explain the given topic. "
         "Prefer academic sources, educational websites, or reputable publications. "
         "Return as a JSON array of objects with 'title' and 'url' fields."
+    ),
+    response_mime_type="application/json",
+)
+
+@cached(
+    TTLCache(maxsize=4096, ttl=REFERENCE_CACHE_TTL),
+    key=reference_cache_key,
+    lock=threading.Lock(),
+)
+def _ask_article_references(prompt: str, n: int) -> str:
+    """
+    Ask Gemini for article references and return its raw reply.
+    Cached per (prompt, n) so repeated questions skip the LLM round-trip.
+    """
+    response = get_gemini_client().models.generate_content(
+        model="gemini-2.0-flash",
+        contents=f"Number of resources: {n}\nTopic: {prompt}",
+        config=ARTICLE_CONFIG,
     )
-    response = client.models.generate_content(model="gemini-2.0-flash", contents=article_prompt)
-    raw = response.text.strip()
+    return response.text.strip()
+
+# Gemini usually wraps JSON replies in a ```json ... ``` fence
+_FENCE_RE = re.compile(r"^\s*```[^\n]*\n(.*?)\n?```\s*$", re.DOTALL)
+# Fallback when the reply isn't JSON: pull out anything that looks like a link
+_URL_RE = re.compile(r"https?://[^\s\"'<>]+")
+
+def get_article_references(prompt: str, n: int = 2) -> list:
+    raw = _ask_article_references(prompt, n)
+    m = _FENCE_RE.match(raw)
+    if m:
+        raw = m.group(1)
     try:
-        return json.loads(raw)
+        return orjson.loads(raw)
     except Exception:
-        urls = [u.strip() for u in raw.splitlines() if u.startswith("http")]
-        return [{"title": f"Reference Article {i+1}", "url": url} for i, url in enumerate(urls)]
+        return [
+            {"title": f"Reference Article {i+1}", "url": url_match.group()}
+            for i, url_match in enumerate(_URL_RE.finditer(raw))
+        ]
 
 ###############################################################################
 # Background Task Functions (S3-only)
 ###############################################################################
 def background_video_generation(topic: str) -> tuple:
+    py_file = output_dir = None
     try:
-        logging.info("Generating video for topic: %s", topic)
-        outline = generate_outline(topic)
-        code = generate_code(topic, outline)
-        py_file, uid = write_temp(code)
-        rendered_path = render_voiceover_scene(py_file, uid)
-
-        
         video_key = generate_video_key(topic)
         video_filename = f"{video_key}.mp4"
+        # A job retried after its upload succeeded (or a racing duplicate)
+        # finds the render already in S3 and skips the LLM + Manim pipeline.
+        existing_url = get_existing_video_url(video_filename)
+        if existing_url:
+            logging.info("Video already rendered: %s", existing_url)
+            return video_key, existing_url
+
+        logging.info("Generating video for topic: %s", topic)
+        kb_block = build_kb_block(topic)
+        outline = generate_outline(topic, kb_block)
+        code = generate_code(topic, outline, kb_block)
+        py_file, uid = write_temp(code)
+        # Render into a private directory so concurrent jobs never share Manim output.
+        output_dir = tempfile.mkdtemp(prefix=f"manim-{uid}-")
+        rendered_path = render_voiceover_scene(py_file, uid, output_dir, scene=scene_class_name(code))
+        remember_rendered_code(topic, kb_block, code)
 
         video_url = upload_file_to_s3(rendered_path, video_filename)
-        try:
-            os.remove(py_file)
-        except Exception as cleanup_err:
-            logging.warning("Failed to delete temp file %s: %s", py_file, cleanup_err)
-        
         return video_key, video_url
     except Exception as e:
         logging.error("Error generating video: %s", e, exc_info=True)
         return None, None
-
-# def background_mcq_review(topic: str, question: str) -> tuple:
-#     """
-#     Generates an MCQ review video.
-#     Uses S3 exclusively to store both the video and a JSON response with reference links.
-#     Returns a tuple: (video_key, video_url)
-#     """
-#     try:
-#         logging.info("Generating MCQ review video for topic: %s", topic)
-#         outline = generate_outline(topic)
-#         code = generate_code(topic, outline)
-#         py_file, uid = write_temp(code)
-#         rendered_path = render_voiceover_scene(py_file, uid)
-
-        
-#         video_key = generate_video_key(topic)
-#         video_filename = f"{video_key}.mp4"
-        
-#         if S3_BUCKET:
-#             video_url = upload_file_to_s3(rendered_path, video_filename)
-#             logging.info("MCQ review video uploaded to S3: %s", video_url)
-#         else:
-#             raise Exception("S3_BUCKET is not configured.")
-        
-#         youtube_refs = get_youtube_references(question)
-#         article_refs = get_article_references(question)
-#         video_title = f"Explanation: {question[:50]}{'...' if len(question) > 50 else ''}"
-#         response = {
-#             "resources": {
-#                 "video": {"title": video_title, "url": video_url},
-#                 "ref_videos": youtube_refs,
-#                 "ref_articles": article_refs
-#             }
-#         }
-        
-#         json_key = f"{video_key}.json"
-#         s3_client = boto3.client("s3")
-#         s3_client.put_object(
-#             Bucket=S3_BUCKET,
-#             Key=json_key,
-#             Body=json.dumps(response).encode("utf-8"),
-#             ContentType="application/json"
-#         )
-#         logging.info("JSON response uploaded to S3 under key %s", json_key)
-        
-#         try:
-#             os.remove(py_file)
-#         except Exception as cleanup_err:
-#             logging.warning("Failed to delete temp file %s: %s", py_file, cleanup_err)
-        
-#         return video_key, video_url
-#     except Exception as e:
-#         logging.error("Error generating MCQ review video: %s", e, exc_info=True)
-#         return None, None
+    finally:
+        # Clean up on failure too, so failed renders don't accumulate in /tmp
+        if py_file:
+            try:
+                os.remove(py_file)
+            except FileNotFoundError:
+                pass
+            except Exception as cleanup_err:
+                logging.warning("Failed to delete temp file %s: %s", py_file, cleanup_err)
+        if output_dir:
+            shutil.rmtree(output_dir, ignore_errors=True)
 
 ###############################################################################
 # API Endpoints
 ###############################################################################
+# Body of the 202 reply sent to every poll until the worker finishes.
+# Only the bytes are shared: a Response instance can't be reused because
+# the CORS middleware appends headers to it in place.
+PROCESSING_BODY = b'{"status":"processing"}'
+# Lets a proxy collapse tight poll loops without hiding completion for long
+PROCESSING_HEADERS = {"Cache-Control": "max-age=1"}
+
+# Finished results never change (keys are prompt hashes), so a completed key
+# is served from memory instead of re-reading S3 on every poll.
+_finished_bodies = LRUCache(maxsize=2048)
+
+async def _status(video_key: str, request: Request):
+    """
+    Polling logic shared by the status endpoints: return the JSON response
+    stored in S3 as <video_key>.json, or a processing status until it lands.
+    """
+    body = _finished_bodies.get(video_key)
+    if body is not None:
+        return result_response(body, request)
+    try:
+        # get_object + read block on the network; keep them off the event loop
+        body = await asyncio.to_thread(read_result, video_key)
+    except s3_client.exceptions.ClientError as e:
+        error_code = e.response['Error']['Code']
+        if error_code in ('NoSuchKey', '404'):
+            return Response(
+                content=PROCESSING_BODY,
+                media_type="application/json",
+                status_code=202,
+                headers=PROCESSING_HEADERS,
+            )
+        else:
+            return JSONResponse(content={"error": "Error accessing S3", "details": str(e)}, status_code=500)
+    _finished_bodies[video_key] = body
+    _inflight_jobs.pop(video_key, None)
+    return result_response(body, request)
+
 @app.post("/generate_video")
-async def generate_video(request_data: VideoGenerationRequest, background_tasks: BackgroundTasks):
+async def generate_video(request_data: VideoGenerationRequest, background_tasks: BackgroundTasks, request: Request):
     """
     Triggers video generation for a given question.
     Returns a message with the computed video key and status endpoint for polling.
     """
     question = request_data.question
     user_ans = request_data.user_answer
-    prompt = (
-        f"Here's a question: \"{question}\".\n"
-        f"The user answered: \"{user_ans}\".\n\n"
-        "Generate a short explanatory video script that:\n"
-        "1️⃣ Explains the expected answer in detail.\n"
-        "2️⃣ Points out where the user's answer is missing or incorrect.\n"
-        "3️⃣ Provides clear guidance on how to improve."
-    )
+    prompt = VIDEO_PROMPT_TEMPLATE.format(question=question, user_answer=user_ans)
     video_key = generate_video_key(prompt)
-    json_key = f"{video_key}.json"
-
-    s3_client = boto3.client("s3")
-    # 1) Check if we've already generated this
-    try:
-        s3_client.head_object(Bucket=S3_BUCKET, Key=json_key)
-        # If it exists, just fetch and return it immediately
-        obj = s3_client.get_object(Bucket=S3_BUCKET, Key=json_key)
-        existing = json.loads(obj["Body"].read().decode("utf-8"))
-        return JSONResponse(content=existing, status_code=200)
-    except s3_client.exceptions.ClientError as e:
-        if e.response['Error']['Code'] != '404':
-            # Some other S3 error
-            logging.error("Error checking S3 for existing JSON: %s", e)
-            raise HTTPException(status_code=500, detail="Error checking cache")
-        
-    trigger_cloud_run_job(
-        job_name="my-worker-job",
-        region="us-central1",
-        project_id="gen-lang-client-0755469978",
-        prompt=prompt
+    # 1) Check if we've already generated this; if so return it immediately
+    existing = await asyncio.to_thread(get_existing_response, video_key)
+    if existing is not None:
+        _inflight_jobs.pop(video_key, None)
+        return result_response(existing, request)
+
+    # The prompt upload + job trigger don't feed the response, so they run
+    # after it is sent; only the reference lookups are awaited here, and the
+    # job reuses them. A repeat of a question already rendering joins that job.
+    youtube_refs, article_refs = await asyncio.gather(
+        asyncio.to_thread(get_youtube_references, question),
+        asyncio.to_thread(get_article_references, question),
+    )
+    background_tasks.add_task(
+        start_job, video_key, prompt,
+        {"ref_videos": youtube_refs, "ref_articles": article_refs},
     )
-    youtube_refs = get_youtube_references(question)
-    article_refs = get_article_references(question)
     return JSONResponse(content={
         "resources": {
             "video": {
@@ -317,24 +617,11 @@ async def generate_video(request_data: VideoGenerationRequest, background_tasks:
     }, status_code=202)
 
 @app.get("/status/video/{video_key}")
-async def video_status(video_key: str):
-    s3_client = boto3.client("s3")
-    json_key = f"{video_key}.json"
-    try:
-        s3_client.head_object(Bucket=S3_BUCKET, Key=json_key)
-        obj = s3_client.get_object(Bucket=S3_BUCKET, Key=json_key)
-        response_content = obj["Body"].read().decode("utf-8")
-        response_data = json.loads(response_content)
-        return JSONResponse(content=response_data, status_code=200)
-    except s3_client.exceptions.ClientError as e:
-        error_code = e.response['Error']['Code']
-        if error_code == '404':
-            return JSONResponse(content={"status": "processing"}, status_code=202)
-        else:
-            return JSONResponse(content={"error": "Error accessing S3", "details": str(e)}, status_code=500)
+async def video_status(video_key: str, request: Request):
+    return await _status(video_key, request)
 
 @app.post("/review/mcq")
-async def review_mcq(request_data: MCQReviewRequest, background_tasks: BackgroundTasks):
+async def review_mcq(request_data: MCQReviewRequest, background_tasks: BackgroundTasks, request: Request):
     """
     Triggers MCQ review video generation.
     Returns reference links immediately and indicates the status endpoint for polling.
@@ -342,31 +629,29 @@ async def review_mcq(request_data: MCQReviewRequest, background_tasks: Backgroun
     question = request_data.question
     user_ans = request_data.selected_option
     correct_ans = request_data.expected_answer
-    prompt = (
-        f"Here's a multiple-choice question: \"{question}\".\n"
-        f"The user selected answer: \"{user_ans}\".\n"
-        f"The correct answer is: \"{correct_ans}\".\n\n"
-        "Generate a short explanatory video script that:\n"
-        "1️⃣ Explains why the correct answer is right.\n"
-        "2️⃣ If the user's answer is wrong, explains the misconception or error.\n"
-        "3️⃣ Provides key concepts to remember for similar questions."
-    )
-    youtube_refs = get_youtube_references(question)
-    article_refs = get_article_references(question)
-    # background_tasks.add_task(background_mcq_review, prompt, question)
-    
-    trigger_cloud_run_job(
-        job_name="my-worker-job",
-        region="us-central1",
-        project_id="gen-lang-client-0755469978",
-        prompt=prompt
+    prompt = MCQ_PROMPT_TEMPLATE.format(
+        question=question, selected_option=user_ans, expected_answer=correct_ans
     )
     # Generate a deterministic video key for this prompt
     video_key = generate_video_key(prompt)
+    # A repeated question is served from the finished render instead of a new job
+    existing = await asyncio.to_thread(get_existing_response, video_key)
+    if existing is not None:
+        _inflight_jobs.pop(video_key, None)
+        return result_response(existing, request)
+
+    youtube_refs, article_refs = await asyncio.gather(
+        asyncio.to_thread(get_youtube_references, question),
+        asyncio.to_thread(get_article_references, question),
+    )
+    background_tasks.add_task(
+        start_job, video_key, prompt,
+        {"ref_videos": youtube_refs, "ref_articles": article_refs},
+    )
     return JSONResponse(content={
         "resources": {
             "video": {
-                "title": f"Explanation: {question[:50]}{'...' if len(question) > 50 else ''}",
+                "title": video_title(question),
                 "status_endpoint": f"/status/mcq/{video_key}"
             },
             "ref_videos": youtube_refs,
@@ -375,25 +660,8 @@ async def review_mcq(request_data: MCQReviewRequest, background_tasks: Backgroun
     }, status_code=202)
 
 @app.get("/status/mcq/{video_key}")
-async def mcq_status(video_key: str):
-    """
-    Polling endpoint to check for a JSON response stored in S3 with key <video_key>.json.
-    Returns the JSON data if available, otherwise a processing status.
-    """
-    s3_client = boto3.client("s3")
-    json_key = f"{video_key}.json"
-    try:
-        s3_client.head_object(Bucket=S3_BUCKET, Key=json_key)
-        obj = s3_client.get_object(Bucket=S3_BUCKET, Key=json_key)
-        response_content = obj["Body"].read().decode("utf-8")
-        response_data = json.loads(response_content)
-        return JSONResponse(content=response_data, status_code=200)
-    except s3_client.exceptions.ClientError as e:
-        error_code = e.response['Error']['Code']
-        if error_code == '404':
-            return JSONResponse(content={"status": "processing"}, status_code=202)
-        else:
-            return JSONResponse(content={"error": "Error accessing S3", "details": str(e)}, status_code=500)
+async def mcq_status(video_key: str, request: Request):
+    return await _status(video_key, request)
 
 ###############################################################################
 # Optional: HTML Client for Testing
@@ -1,14 +1,23 @@
 import os
 import re
+import argparse
+import ast
+import shutil
 import subprocess
 import glob
+import contextlib
+import fcntl
+import functools
+import hashlib
+import json
+import shelve
+import threading
 import logging
 import uuid
-import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 from dotenv import load_dotenv
-from google import genai
-from sentence_transformers import SentenceTransformer
-from pinecone import Pinecone, ServerlessSpec
 import textwrap
 # import psutil, os
 
@@ -35,15 +44,51 @@ if not ELEVENLABS_API_KEY:
 if not PINECONE_API_KEY:
     raise EnvironmentError("PINECONE_API_KEY missing")
 
-# ── Initialize clients ───────────────────────────────────────────────────
-client = genai.Client(api_key=GEMINI_API_KEY)
-pc = Pinecone(api_key=PINECONE_API_KEY)
+# ── Compiled patterns ────────────────────────────────────────────────────
+_MD_SPLIT = re.compile(r"^##\s+", re.M)
+_CODE_BLOCK = re.compile(r"```python\s*(.*?)```", re.DOTALL)
+_SCENE_CLASS = re.compile(r"class\s+(\w+)\s*\(\s*VoiceoverScene\s*\):")
 
-# ── Build or connect to Pinecone index ──────────────────────────────────
-if PINECONE_INDEX not in pc.list_indexes().names():
-    pc.create_index(name=PINECONE_INDEX, spec=ServerlessSpec(cloud="aws", region=PINECONE_ENV),dimension=384)
-index = pc.Index(PINECONE_INDEX)
-embed_model = SentenceTransformer("all-MiniLM-L6-v2")
+# ── Initialize clients ───────────────────────────────────────────────────
+# Built on first use: importing torch/transformers and resolving the
+# Pinecone index cost seconds that callers like the API (which only needs
+# Gemini) or a --help run shouldn't pay at import.
+@functools.lru_cache(maxsize=None)
+def get_gemini_client():
+    from google import genai
+    return genai.Client(api_key=GEMINI_API_KEY)
+
+@functools.lru_cache(maxsize=None)
+def get_index():
+    from pinecone import Pinecone, ServerlessSpec
+    pc = Pinecone(api_key=PINECONE_API_KEY)
+    # Build or connect to the index
+    if PINECONE_INDEX not in pc.list_indexes().names():
+        pc.create_index(name=PINECONE_INDEX, spec=ServerlessSpec(cloud="aws", region=PINECONE_ENV),dimension=384)
+    return pc.Index(PINECONE_INDEX, pool_threads=30)
+
+@functools.lru_cache(maxsize=None)
+def get_embed_model():
+    from sentence_transformers import SentenceTransformer
+    # SentenceTransformer already picks CUDA/MPS when present; on CUDA, fp16
+    # roughly halves encode time and the unit vectors lose nothing that
+    # matters for cosine ranking.
+    embed_model = SentenceTransformer("all-MiniLM-L6-v2")
+    if embed_model.device.type == "cuda":
+        embed_model.half()
+    return embed_model
+
+def _reset_clients():
+    """
+    ProcessPoolExecutor initializer: drop clients inherited through fork so
+    each child opens its own connection pool and Pinecone threads, and loads
+    its own embedding model instead of reusing the parent's torch state
+    (its OpenMP pool doesn't survive fork and can hang the child).
+    """
+    get_gemini_client.cache_clear()
+    get_index.cache_clear()
+    get_embed_model.cache_clear()
+    embed_query.cache_clear()
 
 # ── Upload KB to Pinecone ─────────────────────────────────────────────────
 KB_SOURCE = "/Users/mat/Desktop/Proj/Solutioon/kb.txt"
@@ -52,16 +97,16 @@ def load_kb(path: str):
     if os.path.isdir(path):
         # split each file into sections by top-level headings
         for md in glob.glob(os.path.join(path, "*.md")):
-            text = open(md, encoding="utf-8").read()
-            parts = re.split(r"(?m)^##\s+", text)
-            for part in parts[1:]:
-                lines = part.splitlines()
-                title = lines[0].strip()
-                body = "\n".join(lines[1:]).strip()
-                entries.append((f"{os.path.basename(md)}::{title}", body))
+            text = Path(md).read_text(encoding="utf-8")
+            # slice sections out by heading offsets instead of splitting copies
+            heads = list(_MD_SPLIT.finditer(text))
+            for head, nxt in zip(heads, heads[1:] + [None]):
+                section = text[head.end() : nxt.start() if nxt else len(text)]
+                title, _, body = section.partition("\n")
+                entries.append((f"{os.path.basename(md)}::{title.strip()}", body.strip()))
     elif os.path.isfile(path):
         # read entire file as one entry
-        text = open(path, encoding="utf-8").read()
+        text = Path(path).read_text(encoding="utf-8")
         entries.append((os.path.basename(path), text))
     else:
         raise FileNotFoundError(f"KB_SOURCE not found: {path}")
@@ -69,61 +114,253 @@ def load_kb(path: str):
 
 
 
-# batch upsert embeddings with normalization
-import numpy as np
+# Local record of {entry id: content hash} for what's already been upserted,
+# so startup doesn't have to ask Pinecone and unchanged entries aren't re-embedded.
+KB_MANIFEST = os.getenv(
+    "KB_MANIFEST", os.path.join(os.path.dirname(KB_SOURCE), "kb_manifest.json")
+)
 
-def normalize(v: list[float]) -> list[float]:
-    arr = np.array(v, dtype=np.float32)
-    norm = np.linalg.norm(arr)
-    return (arr / norm).tolist() if norm > 0 else v
+def kb_hash(body: str) -> str:
+    return hashlib.blake2b(body.encode("utf-8"), digest_size=16).hexdigest()
+
+# Bump when what's stored per vector changes; an older manifest is ignored so
+# every entry gets re-upserted. 2: section text stored in metadata.
+KB_SCHEMA = 2
+# Per-section text kept in Pinecone metadata (well under its 40 KB limit)
+KB_TEXT_LIMIT = 4000
+
+def load_kb_manifest(path: str) -> dict:
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if not isinstance(data, dict) or data.get("schema") != KB_SCHEMA:
+        return {}
+    return data["entries"]
+
+def save_kb_manifest(path: str, manifest: dict):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"schema": KB_SCHEMA, "entries": manifest}, f)
+    os.replace(tmp, path)
+
+def kb_source_mtime(path: str) -> float:
+    if os.path.isdir(path):
+        return max((os.path.getmtime(md) for md in glob.glob(os.path.join(path, "*.md"))), default=0.0)
+    return os.path.getmtime(path)
 
-if os.path.exists(KB_SOURCE):
+def ensure_kb_uploaded(force: bool = False):
+    """
+    Embed and upsert new or changed KB entries. Returns immediately when the
+    manifest is newer than KB_SOURCE, i.e. nothing was edited since the last
+    upload; force=True re-checks every entry's hash regardless.
+    """
+    if not os.path.exists(KB_SOURCE):
+        logging.warning("KB_SOURCE not found: %s. Skipping KB upload.", KB_SOURCE)
+        return
+    manifest = load_kb_manifest(KB_MANIFEST)
+    if (
+        not force
+        and manifest
+        and os.path.getmtime(KB_MANIFEST) >= kb_source_mtime(KB_SOURCE)
+    ):
+        logging.info("KB unchanged since last upload; skipping.")
+        return
     logging.info("Loading KB entries from %s", KB_SOURCE)
     entries = load_kb(KB_SOURCE)
     logging.info("Found %d KB entries", len(entries))
 
-    existing = set(index.fetch(ids=[key for key, _ in entries]).vectors.keys())
-    to_upload = [(key, body) for key, body in entries if key not in existing]
+    # Entries whose content hash matches the manifest are already in the index
+    hashes = {key: kb_hash(body) for key, body in entries}
+    to_upload = [(key, body) for key, body in entries if manifest.get(key) != hashes[key]]
     if not to_upload:
         logging.info("No new KB entries to upload.")
     else:
-        batch_size = 50
+        # Encode batch N+1 while batch N is upserted on the index's thread
+        # pool; capping in-flight upserts bounds memory on large KBs.
+        batch_size = 100
+        max_in_flight = 8
+        pending = deque()
         for i in range(0, len(to_upload), batch_size):
             batch = to_upload[i : i + batch_size]
-            texts = [body for _, body in batch]
-            ids = [key for key, _ in batch]
-            embs = embed_model.encode(texts, convert_to_numpy=True)
-            vecs = [normalize(embs[j]) for j in range(len(ids))]
-            vectors = [(ids[j], vecs[j]) for j in range(len(ids))]
-            index.upsert(vectors=vectors)
+            # Unit-length vectors straight from the encoder
+            embs = get_embed_model().encode(
+                [body for _, body in batch],
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                batch_size=64,
+                show_progress_bar=False,
+            )
+            vectors = [
+                (key, emb, {"text": body[:KB_TEXT_LIMIT]})
+                for (key, body), emb in zip(batch, embs.tolist())
+            ]
+            if len(pending) >= max_in_flight:
+                pending.popleft().get()
+            pending.append(get_index().upsert(vectors=vectors, async_req=True))
+        for result in pending:
+            result.get()
+        manifest.update((key, hashes[key]) for key, _ in to_upload)
         logging.info("Uploaded KB to Pinecone index '%s'", PINECONE_INDEX)
-else:
-    logging.warning("KB_SOURCE not found: %s. Skipping KB upload.", KB_SOURCE)
+    # Rewritten even when nothing changed so its mtime marks this check
+    save_kb_manifest(KB_MANIFEST, manifest)
 
 
-def normalize(v: list[float]) -> list[float]:
-    arr = np.array(v, dtype=np.float32)
-    norm = np.linalg.norm(arr)
-    return (arr / norm).tolist() if norm > 0 else v
-
+@functools.lru_cache(maxsize=1024)
+def embed_query(text: str) -> tuple:
+    """
+    Unit-length MiniLM embedding of text, cached so repeated queries skip
+    the forward pass. A tuple, so callers can't mutate the cached value.
+    """
+    q_emb = get_embed_model().encode(
+        text, convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=False
+    )
+    return tuple(q_emb.tolist())
 
 def retrieve_sections(query: str, top_k: int = 20):
-    q_emb = embed_model.encode([query], convert_to_numpy=True)[0]
-    q_emb = normalize(q_emb)
-    res = index.query(vector=q_emb, top_k=top_k)
+    """
+    Return (id, text) for the top_k KB sections closest to query. The text
+    comes back with the match, so no second lookup is needed.
+    """
+    res = get_index().query(vector=list(embed_query(query)), top_k=top_k, include_metadata=True)
     matches = res.matches if hasattr(res, 'matches') else res['results'][0]['matches']
-    return [m.id for m in matches]
+    return [(m.id, (m.metadata or {}).get("text", "")) for m in matches]
 
 
 
 # ── Outline generation ─────────────────────────────────────────────────────
-def ask_gemini(prompt: str) -> str:
-    resp = client.models.generate_content(model="gemini-2.0-flash", contents=prompt)
-    return resp.text or ""
+# Completions for identical prompts are reused: in memory for the life of the
+# process and, if GEMINI_CACHE_DB names a file, on disk across runs.
+GEMINI_MODEL = "gemini-2.0-flash"
+GEMINI_CACHE_DB = os.getenv("GEMINI_CACHE_DB")
+_gemini_shelf_lock = threading.Lock()
+
+def _cache_key(kind: str, prompt: str) -> str:
+    # The model is part of the key so switching models never serves stale output
+    return f"{kind}:{GEMINI_MODEL}:" + hashlib.blake2b(prompt.encode("utf-8"), digest_size=16).hexdigest()
+
+@contextlib.contextmanager
+def _open_shelf():
+    """
+    GEMINI_CACHE_DB opened under an exclusive lock. The threading lock covers
+    this process; flock on a sidecar file covers main()'s worker processes,
+    which would otherwise open the same dbm file at once.
+    """
+    with _gemini_shelf_lock, open(GEMINI_CACHE_DB + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            with shelve.open(GEMINI_CACHE_DB) as shelf:
+                yield shelf
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _shelf_get(key: str):
+    if not GEMINI_CACHE_DB:
+        return None
+    with _open_shelf() as shelf:
+        return shelf.get(key)
+
+def _shelf_put(key: str, value: str):
+    if GEMINI_CACHE_DB:
+        with _open_shelf() as shelf:
+            shelf[key] = value
+
+def ask_gemini(prompt: str, system_instruction: str = None, cache: bool = True) -> str:
+    """
+    Gemini's reply to prompt. cache=False always asks the model and stores
+    nothing, for replies the caller still has to validate (generated code).
+    """
+    if not cache:
+        return _generate(prompt, system_instruction) or ""
+    try:
+        return _cached_completion(prompt, system_instruction)
+    except ValueError:
+        # empty reply; not cached so the next call asks again
+        return ""
+
+@functools.lru_cache(maxsize=256)
+def _cached_completion(prompt: str, system_instruction: str = None) -> str:
+    key = _cache_key("completion", f"{system_instruction or ''}\0{prompt}")
+    cached = _shelf_get(key)
+    if cached is not None:
+        return cached
+    text = _generate(prompt, system_instruction)
+    if not text:
+        raise ValueError("empty Gemini response")
+    _shelf_put(key, text)
+    return text
+
+# With GEMINI_CONTEXT_CACHE=1, long system instructions are uploaded once as
+# a Gemini cached context and referenced by name, so their tokens are billed
+# at the cached rate instead of being resent on every call.
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE") == "1"
+GEMINI_CONTEXT_CACHE_TTL = "3600s"
+
+def _generate(prompt: str, system_instruction: str = None) -> str:
+    from google.genai import types
+    client = get_gemini_client()
+    if system_instruction is None:
+        return client.models.generate_content(model=GEMINI_MODEL, contents=prompt).text or ""
+    cache_name = _context_cache(system_instruction) if GEMINI_CONTEXT_CACHE else None
+    if cache_name:
+        try:
+            return _stream_until_code(
+                client, prompt, types.GenerateContentConfig(cached_content=cache_name)
+            )
+        except Exception as e:
+            # expired or deleted; recreate next time, send inline now
+            logging.warning("Gemini context cache %s unusable: %s", cache_name, e)
+            _context_cache.cache_clear()
+    return _stream_until_code(
+        client, prompt, types.GenerateContentConfig(system_instruction=system_instruction)
+    )
+
+def _stream_until_code(client, prompt: str, config) -> str:
+    """
+    Stream a completion and stop reading once it holds a complete ```python
+    block: extract_code only ever uses the first one, so anything after it
+    is wasted generation time.
+    """
+    parts = []
+    for chunk in client.models.generate_content_stream(
+        model=GEMINI_MODEL, contents=prompt, config=config
+    ):
+        if not chunk.text:
+            continue
+        parts.append(chunk.text)
+        if "`" in chunk.text and _CODE_BLOCK.search("".join(parts)):
+            break
+    return "".join(parts)
+
+@functools.lru_cache(maxsize=8)
+def _context_cache(system_instruction: str):
+    """Name of a Gemini cached context holding system_instruction, or None."""
+    from google.genai import types
+    try:
+        cache = get_gemini_client().caches.create(
+            model=GEMINI_MODEL,
+            config=types.CreateCachedContentConfig(
+                system_instruction=system_instruction,
+                ttl=GEMINI_CONTEXT_CACHE_TTL,
+            ),
+        )
+    except Exception as e:
+        logging.warning("Could not create Gemini context cache: %s", e)
+        return None
+    return cache.name
 
-def generate_outline(topic: str) -> str:
-    ids = retrieve_sections(topic, top_k=3)
-    kb_block = "\n\n".join(f"### {id}" for id in ids)
+def build_kb_block(topic: str) -> str:
+    """
+    The KB sections most relevant to topic (heading + text), for the prompts.
+    Build it once per topic and pass it to generate_outline/generate_code.
+    """
+    sections = retrieve_sections(topic, top_k=3)
+    return "\n\n".join(f"### {id}\n{text}" for id, text in sections)
+
+def generate_outline(topic: str, kb_block: str = None) -> str:
+    if kb_block is None:
+        kb_block = build_kb_block(topic)
     prompt = f"""
 Below are Manim documentation section relevant to “{topic}”:
 
@@ -132,21 +369,16 @@ Below are Manim documentation section relevant to “{topic}”:
 **Step 1:** List, in bullet form, the exact Manim classes, methods, and snippets you’ll need to build a VoiceoverScene that explains “{topic}. Make sure that you extract the full code with its methods so that u can use it properly and not run into error like this for example :AttributeError: 'Camera' object has no attribute 'frame'
 """
     outline = ask_gemini(prompt)
-    logging.info("Outline for '%s':\n%s", topic, outline)
+    logging.debug("Outline for '%s':\n%s", topic, outline)
     return outline.strip()
 
 # ── Code generation ──────────────────────────────────────────────────────
-def extract_code(markdown: str) -> str:
-    m = re.search(r"```python\s*(.*?)```", markdown, re.DOTALL)
-    return m.group(1).strip() if m else markdown.strip()
-
-def generate_code(topic: str, outline: str, max_attempts: int = 3) -> str:
-    ids = retrieve_sections(topic, top_k=3)
-    kb_block = "\n\n".join(f"### {{id}}" for id in ids)
-    base_prompt = f'''
+# Static instructions for generate_code. Kept free of per-topic text so it
+# can be sent as a system instruction and, optionally, cached server-side.
+CODE_SYSTEM_PROMPT = '''
 ```text
 You are an expert Manim and Python developer, tasked with creating educational animations.
-Your primary goal is to generate a complete, executable Manim script that explains the specified '{topic}' in detail, ensuring it is visually understandable and engaging.
+Your primary goal is to generate a complete, executable Manim script that explains the given topic in detail, ensuring it is visually understandable and engaging.
 
 The script MUST use the "manim-voiceover" plugin with the ElevenLabsService for narration.
 
@@ -185,7 +417,7 @@ The script MUST use the "manim-voiceover" plugin with the ElevenLabsService for
 6.  **Code Validity:**
     *   The generated Python code MUST be fully executable without errors.
     *   It MUST use standard `manim-voiceover` usage patterns.
-    *   It MUST NOT rely on placeholders (other than `{topic}` which you will fill), undefined variables, or unimported references.
+    *   It MUST NOT rely on placeholders (other than the topic itself, which you will fill), undefined variables, or unimported references.
 
 **CRITICAL - Overlap Prevention & Scene Management:**
 
@@ -296,7 +528,7 @@ This is a non-negotiable requirement. Visual clarity is paramount.
 
 **Mathematical Clarity (`MathTex`):**
 
-*   Format LaTeX clearly. Use `aligned` environments for multi-line equations where appropriate (`r"""\begin{{aligned}} ... \end{{aligned}}"""`).
+*   Format LaTeX clearly. Use `aligned` environments for multi-line equations where appropriate (`r"""\begin{aligned} ... \end{aligned}"""`).
 *   Break down complex formulas visually if it aids understanding.
 *   When defining a `MathTex` object by passing multiple distinct strings (e.g., `eq = MathTex("E", "=", "m", "c^2")`), each string becomes a directly accessible sub-mobject using standard list indexing (e.g., `eq[0]` is "E", `eq[2]` is "m"). This is more reliable than searching by TeX string content.
 
@@ -337,8 +569,8 @@ from manim import *
 class LaTeXWrappedTextScene(Scene):
     def construct(self):
         tex = Tex(
-            r"\begin{{minipage}}{{6cm}}This is a long LaTeX-formatted text that "
-            r"will wrap within the specified minipage width.\end{{minipage}}",
+            r"\begin{minipage}{6cm}This is a long LaTeX-formatted text that "
+            r"will wrap within the specified minipage width.\end{minipage}",
             tex_environment="flushleft"
         )
         self.add(tex)
@@ -518,10 +750,7 @@ At the very end of the `construct` method, include this exact block to prevent r
 **General Constraints:**
 
 *   **No PNGs:** Do NOT use any PNG images or attempt to load external image files. The animation must be generated purely from Manim code.
-*   **Manim Documentation Snippets:** You may refer to the following Manim documentation snippets if they are relevant to the `{topic}`:
-    ```
-    {kb_block}
-    ```
+*   **Manim Documentation Snippets:** You may refer to the Manim documentation snippets provided alongside the topic if they are relevant to it.
 
 **Verification Mindset Before Outputting:**
 
@@ -531,7 +760,7 @@ Mentally review the generated code, specifically checking for:
 *   **TypeErrors:** Are function/method arguments of the correct type (e.g., `ManimColor` vs. `str` for `interpolate_color`, correct `Code` class instantiation)?
 *   **AttributeErrors:** Does the object have the method being called (e.g., avoiding `self.mobjects_last_animation`)?
 *   **Manim API Adherence:** Is the code using Manim and `manim-voiceover` APIs correctly?
-*   **Completeness:** Is the explanation of `{topic}` detailed and visually supported?
+*   **Completeness:** Is the explanation of the topic detailed and visually supported?
 *   **All Requirements Met:** Have all instructions in this prompt been followed?
 
 VERY IMPORTANT:
@@ -549,46 +778,132 @@ VERY IMPORTANT:
 ```
 '''
 
-    prompt = base_prompt
+def extract_code(markdown: str) -> str:
+    m = _CODE_BLOCK.search(markdown)
+    return m.group(1).strip() if m else markdown.strip()
+
+def _syntax_pointer(se: SyntaxError) -> str:
+    """The offending line with carets under the span ast.parse reported."""
+    if not se.text or not se.offset:
+        return ""
+    line = se.text.rstrip("\n")
+    # end_offset only bounds the span when the error sits on a single line
+    end = se.end_offset if se.end_lineno == se.lineno and se.end_offset else se.offset + 1
+    width = max(end - se.offset, 1)
+    return f"{line}\n{' ' * (se.offset - 1)}{'^' * width}"
+
+def _code_prompt(topic: str, kb_block: str) -> str:
+    # Only the topic and KB snippets vary; the long instructions are sent as
+    # a constant system instruction (see CODE_SYSTEM_PROMPT).
+    return (
+        f"Topic: {topic}\n\n"
+        f"Manim documentation snippets:\n```\n{kb_block}\n```\n"
+    )
+
+def _code_cache_key(base_prompt: str) -> str:
+    # New kind so entries stored after a bare parse check are never served
+    return _cache_key("rendered-code", f"{CODE_SYSTEM_PROMPT}\0{base_prompt}")
+
+def remember_rendered_code(topic: str, kb_block: str, code: str):
+    """
+    Cache code for generate_code once Manim has rendered it. Parsing alone
+    isn't enough: a script that fails at render time would otherwise be
+    replayed on every retry.
+    """
+    _shelf_put(_code_cache_key(_code_prompt(topic, kb_block)), code)
+
+def generate_code(topic: str, outline: str, kb_block: str = None, max_attempts: int = 3) -> str:
+    if kb_block is None:
+        kb_block = build_kb_block(topic)
+    base_prompt = _code_prompt(topic, kb_block)
+
+    # Code that already rendered for this exact prompt is reused, skipping
+    # the retry loop as well as the first call.
+    cached = _shelf_get(_code_cache_key(base_prompt))
+    if cached is not None:
+        logging.info("Using cached code for '%s'", topic)
+        return cached
+
+    raw = ask_gemini(base_prompt, system_instruction=CODE_SYSTEM_PROMPT, cache=False)
     for attempt in range(1, max_attempts+1):
-        raw = ask_gemini(prompt)
         code = extract_code(raw)
         try:
-            compile(code, '<string>', 'exec')
+            # parse only; no bytecode is needed just to validate syntax
+            ast.parse(code)
             return code
-        except SyntaxError:
-            err = traceback.format_exc()
-            logging.warning("Syntax error on attempt %d:\n%s", attempt, err)
-            prompt = base_prompt + f"\nPrevious code raised SyntaxError:\n{err}\nPlease correct and resend."
+        except SyntaxError as se:
+            logging.warning("Syntax error on attempt %d: %s (line %s, col %s)",
+                            attempt, se.msg, se.lineno, se.offset)
+            if attempt == max_attempts:
+                break
+            # The script is otherwise complete, so only ask for the fix
+            # instead of re-sending the whole generation prompt.
+            fix_prompt = (
+                "Fix only the Python syntax error; return the complete script.\n\n"
+                f"Error: {se.msg} at line {se.lineno}, column {se.offset}\n"
+                f"{_syntax_pointer(se)}\n\n"
+                f"Code:\n```python\n{code}\n```"
+            )
+            raw = ask_gemini(fix_prompt, cache=False)
     raise RuntimeError(f"Failed to generate code for '{topic}' after {max_attempts} attempts.")
 
 # ── Manim rendering ───────────────────────────────────────────────────────
 def write_temp(code: str):
     uid = uuid.uuid4().hex
     fname = f"/tmp/{uid}.py"
-    with open(fname, 'w', encoding='utf-8') as f:
-        f.write(code)
+    # One unbuffered write of the pre-encoded script instead of going through
+    # a text-mode file object
+    data = memoryview(code.encode("utf-8"))
+    fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
     return fname, uid
 
-def render_voiceover_scene(py_file: str, base_uuid: str) -> str:
+def _tail(path: str, limit: int = 8192) -> str:
+    """Last limit bytes of a log file, decoded for logging."""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(f.tell() - limit, 0))
+        return f.read().decode("utf-8", "replace")
+
+def scene_class_name(code: str) -> str:
+    """Name of the VoiceoverScene subclass defined in code."""
+    match = _SCENE_CLASS.search(code)
+    if not match:
+        raise ValueError("No VoiceoverScene subclass found in generated code")
+    return match.group(1)
+
+def render_voiceover_scene(py_file: str, base_uuid: str, output_dir: str = None, scene: str = None) -> str:
     """
     Renders the Manim Voiceover scene from the given file.
+    Manim writes into output_dir (defaults to /tmp/<base_uuid>_output); the
+    caller owns that directory and should remove it once the video is used.
+    Pass scene (see scene_class_name) when the code is at hand to skip
+    re-reading py_file.
     Returns the path to the rendered video file.
     """
     # 1) Extract scene name
-    content = open(py_file, "r", encoding="utf-8").read()
-    match = re.search(r'class\s+(\w+)\s*\(\s*VoiceoverScene\s*\):', content)
-    if not match:
-        raise ValueError(f"No VoiceoverScene subclass found in {py_file}")
-    scene = match.group(1)
+    if scene is None:
+        # class statements fit on one line; stop at the first match
+        with open(py_file, "r", encoding="utf-8") as f:
+            for line in f:
+                match = _SCENE_CLASS.search(line)
+                if match:
+                    scene = match.group(1)
+                    break
+            else:
+                raise ValueError(f"No VoiceoverScene subclass found in {py_file}")
 
     # 2) Render with --media_dir to our output folder
-    output_dir = f"/tmp/{base_uuid}_output"
+    output_dir = output_dir or f"/tmp/{base_uuid}_output"
     cmd = [
     "manim",
     py_file,       # e.g., /tmp/b4744b3e17ff4386b389ec9865b9cdea.py
     scene,         # the class name of your scene (e.g., TopicVoiceoverScene)
-    "-pql",
+    "-ql",
     "--fps", "15",
     "--resolution", "640,360",
     "--media_dir", output_dir
@@ -596,18 +911,27 @@ def render_voiceover_scene(py_file: str, base_uuid: str) -> str:
 
 
     logging.info("Running Manim command: %s", " ".join(cmd))
+    # Stream Manim's output to files in output_dir rather than buffering it
+    # all in memory; only the tail is read back if the render fails.
+    os.makedirs(output_dir, exist_ok=True)
+    stdout_log = os.path.join(output_dir, "manim.stdout.log")
+    stderr_log = os.path.join(output_dir, "manim.stderr.log")
     try:
-        subprocess.run(cmd, check=True, capture_output=True, text=True, timeout=300)
-    except subprocess.CalledProcessError as e:
-        logging.error("STDOUT:\n%s", e.stdout)
-        logging.error("STDERR:\n%s", e.stderr)
+        with open(stdout_log, "wb") as out, open(stderr_log, "wb") as err:
+            subprocess.run(cmd, check=True, stdout=out, stderr=err, timeout=300)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+        logging.error("STDOUT (tail):\n%s", _tail(stdout_log))
+        logging.error("STDERR (tail):\n%s", _tail(stderr_log))
         raise
 
 
     # 3) Look for the mp4 in that folder
-    # Manim will write: <output_dir>/videos/<quality>/<scene>.mp4
-    pattern = os.path.join(output_dir, "videos", "*", f"{scene}.mp4")
-    files = glob.glob(pattern)
+    # Manim writes <output_dir>/videos/<module>/<height>p<fps>/<scene>.mp4,
+    # all of which the command above fixes, so check that path first.
+    expected = Path(output_dir, "videos", Path(py_file).stem, "360p15", f"{scene}.mp4")
+    if expected.exists():
+        return str(expected)
+    files = glob.glob(os.path.join(output_dir, "videos", "*", "*", f"{scene}.mp4"))
     if not files:
         # fallback to any .mp4 under output_dir
         files = glob.glob(os.path.join(output_dir, "**", f"{scene}.mp4"), recursive=True)
@@ -621,32 +945,55 @@ def render_voiceover_scene(py_file: str, base_uuid: str) -> str:
 
 
 # ── Main flow ────────────────────────────────────────────────────────────
-def main():
-    topics = ["explain how water ias formed in chemisty"]
-    for topic in topics:
-        logging.info("--- Topic: %s ---", topic)
-        # log_memory_usage("Start of topic")
+def process_topic(topic: str):
+    logging.info("--- Topic: %s ---", topic)
+    # log_memory_usage("Start of topic")
 
-        outline = generate_outline(topic)
-        # log_memory_usage("After generating outline")
+    kb_block = build_kb_block(topic)
+    outline = generate_outline(topic, kb_block)
+    # log_memory_usage("After generating outline")
 
-        code = generate_code(topic, outline)
-        # log_memory_usage("After generating code")
+    code = generate_code(topic, outline, kb_block)
+    # log_memory_usage("After generating code")
 
-        logging.info("Code for '%s':\n%s", topic, code)
-        py_file, uid = write_temp(code)
-        # log_memory_usage("After writing temp file")
+    logging.debug("Code for '%s':\n%s", topic, code)
+    py_file, uid = write_temp(code)
+    # log_memory_usage("After writing temp file")
 
-        try:
-            video = render_voiceover_scene(py_file, uid)
-            # log_memory_usage("After rendering video")
-            logging.info("Video saved: %s", video)
-        except Exception as e:
-            logging.error("Render failed: %s", e)
-        finally:
-            if os.path.exists(py_file):
-                os.remove(py_file)
-                # log_memory_usage("After cleaning up temp file")
+    try:
+        video = render_voiceover_scene(py_file, uid, scene=scene_class_name(code))
+        remember_rendered_code(topic, kb_block, code)
+        # log_memory_usage("After rendering video")
+        logging.info("Video saved: %s", video)
+    except Exception as e:
+        logging.error("Render failed: %s", e)
+        shutil.rmtree(f"/tmp/{uid}_output", ignore_errors=True)
+    finally:
+        if os.path.exists(py_file):
+            os.remove(py_file)
+            # log_memory_usage("After cleaning up temp file")
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate Manim voiceover videos.")
+    parser.add_argument("--upload-kb", action="store_true",
+                        help="embed and upsert new/changed KB entries before generating")
+    args = parser.parse_args()
+    if args.upload_kb:
+        ensure_kb_uploaded()
+
+    topics = ["explain how water ias formed in chemisty"]
+    if len(topics) == 1:
+        process_topic(topics[0])
+        return
+    # Topics are independent and each render is CPU-bound, so fan them out
+    # across processes rather than running them back to back.
+    with ProcessPoolExecutor(max_workers=min(len(topics), os.cpu_count() or 1),
+                             initializer=_reset_clients) as ex:
+        for topic, future in [(t, ex.submit(process_topic, t)) for t in topics]:
+            try:
+                future.result()
+            except Exception as e:
+                logging.error("Topic '%s' failed: %s", topic, e)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
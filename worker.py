@@ -1,40 +1,87 @@
 import sys
+import atexit
+import faulthandler
+import gzip
 import logging
-import boto3
-import json
+import orjson
 import os
-from app import background_video_generation, get_youtube_references, get_article_references  
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ThreadPoolExecutor
+from app import (
+    background_video_generation,
+    get_youtube_references,
+    get_article_references,
+    s3_client,
+    # app refuses to import without S3_BUCKET, so it's always set here
+    S3_BUCKET,
+)
 
+# Records are queued and written to stdout by a listener thread, so the
+# render and uploads never wait on a log write; atexit drains the queue.
+_log_queue = queue.SimpleQueue()
+# QueueHandler formats each record before queueing it, so the stdout
+# handler just writes the finished line
+_log_listener = QueueListener(_log_queue, logging.StreamHandler(sys.stdout))
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
     format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[logging.StreamHandler(sys.stdout)]
+    handlers=[QueueHandler(_log_queue)],
+    # app and gen configure the root logger on import; replace that setup
+    force=True,
 )
 logger = logging.getLogger(__name__)
 
-S3_BUCKET = os.getenv("S3_BUCKET", "compre-gen-vid")
-if not S3_BUCKET:
-    logger.error("S3_BUCKET environment variable not set")
-    sys.exit(1)
+def read_prompt(prompt_key):
+    """
+    The prompt for this job: inline from PROMPT, else the S3 object at
+    prompt_key. None if the object doesn't exist.
+    """
+    # Short prompts can be passed inline in the PROMPT env var, which
+    # skips the S3 round trip; the key argument is then ignored.
+    prompt = os.getenv("PROMPT")
+    if prompt:
+        logger.info("Using inline prompt: %.100s", prompt)
+        return prompt
+    logger.info("Received prompt key: %s", prompt_key)
 
-if __name__ == "__main__":
+    # Retrieve prompt from S3 with app's pooled client (same one the upload uses)
+    logger.info("Fetching prompt from s3://%s/%s", S3_BUCKET, prompt_key)
     try:
-        if len(sys.argv) < 2:
-            logger.error("No prompt key provided. Usage: worker.py <prompt_key>")
-            sys.exit(1)
-        prompt_key = sys.argv[1]
-        logger.info(f"Received prompt key: {prompt_key}")
-        
-        # Retrieve prompt from S3
-        s3_client = boto3.client("s3")
-        logger.info(f"Fetching prompt from s3://{S3_BUCKET}/{prompt_key}")
-        try:
-            prompt_obj = s3_client.get_object(Bucket=S3_BUCKET, Key=prompt_key)
-            prompt = prompt_obj["Body"].read().decode("utf-8")
-            logger.info(f"Prompt retrieved: {prompt[:100]}")
-        except s3_client.exceptions.NoSuchKey:
-            logger.error(f"S3 object not found: s3://{S3_BUCKET}/{prompt_key}")
-            sys.exit(1)
+        prompt_obj = s3_client.get_object(Bucket=S3_BUCKET, Key=prompt_key)
+    except s3_client.exceptions.NoSuchKey:
+        logger.error("S3 object not found: s3://%s/%s", S3_BUCKET, prompt_key)
+        return None
+    prompt_bytes = prompt_obj["Body"].read()
+    if prompt_obj.get("ContentEncoding") == "gzip":
+        prompt_bytes = gzip.decompress(prompt_bytes)
+    prompt = prompt_bytes.decode("utf-8")
+    logger.info("Prompt retrieved: %.100s", prompt)
+    return prompt
+
+def run(prompt_key, refs=None):
+    """
+    Generate the video for one prompt and upload its result JSON.
+    refs, the references the API already served, skips the lookups.
+    Returns the process exit code.
+    """
+    prompt = read_prompt(prompt_key)
+    if prompt is None:
+        return 1
+
+    # The lookups are network-bound and independent of the render, so when
+    # the API didn't pass references they run in the background while the
+    # video is generated.
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        if refs is not None:
+            youtube_future = article_future = None
+            logger.info("Using references passed by the API")
+        else:
+            logger.info("Fetching YouTube and article references in the background...")
+            youtube_future = pool.submit(get_youtube_references, prompt)
+            article_future = pool.submit(get_article_references, prompt)
 
         # Call background_video_generation
         logger.info("Running background video generation...")
@@ -43,46 +90,66 @@ if __name__ == "__main__":
 
         if video_key is None or video_url is None:
             logger.error("Video generation failed: video_key or video_url is None")
-            sys.exit(1)
+            return 1
 
-        # Fetch references
-        logger.info("Fetching YouTube references...")
-        youtube_refs = get_youtube_references(prompt)
-        logger.info("YouTube references fetched: %s", youtube_refs)
+        if youtube_future is None:
+            youtube_refs = refs["ref_videos"]
+            article_refs = refs["ref_articles"]
+        else:
+            youtube_refs = youtube_future.result()
+            logger.info("YouTube references fetched: %s", youtube_refs)
+            article_refs = article_future.result()
+            logger.info("Article references fetched: %s", article_refs)
 
-        logger.info("Fetching article references...")
-        article_refs = get_article_references(prompt)
-        logger.info("Article references fetched: %s", article_refs)
-
-        # Build JSON response
-        logger.info("Building JSON response...")
-        response = {
-            "resources": {
-                "video": {"title": f"Explanation: {prompt[:50]}", "url": video_url},
-                "ref_videos": youtube_refs,
-                "ref_articles": article_refs
-            }
+    # Build JSON response
+    logger.info("Building JSON response...")
+    response = {
+        "resources": {
+            "video": {"title": f"Explanation: {prompt[:50]}", "url": video_url},
+            "ref_videos": youtube_refs,
+            "ref_articles": article_refs
         }
-        logger.info("JSON response built: %s", str(response)[:500])
+    }
+    # Full payloads only at DEBUG; the isEnabledFor check skips building
+    # the strings entirely otherwise
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("JSON response built: %s", str(response)[:500])
+
+    # Serialize JSON
+    logger.info("Serializing JSON...")
+    # orjson emits UTF-8 bytes directly (non-ASCII kept as-is, like ensure_ascii=False)
+    json_body = orjson.dumps(response)
+    logger.debug("JSON serialized: %d bytes", len(json_body))
 
-        # Serialize JSON
-        logger.info("Serializing JSON...")
-        json_body = json.dumps(response, ensure_ascii=False)
-        logger.info("JSON serialized: %s", json_body[:500])
+    # Upload JSON to S3
+    json_key = f"{video_key}.json"
+    logger.info("Uploading JSON to s3://%s/%s", S3_BUCKET, json_key)
+    s3_client.put_object(
+        Bucket=S3_BUCKET,
+        Key=json_key,
+        # Stored compressed; the API forwards it as-is to gzip-capable clients
+        Body=gzip.compress(json_body, compresslevel=3),
+        ContentType="application/json",
+        ContentEncoding="gzip",
+    )
+    logger.info("JSON uploaded to S3: %s", json_key)
 
-        # Upload JSON to S3
-        json_key = f"{video_key}.json"
-        logger.info("Uploading JSON to s3://%s/%s", S3_BUCKET, json_key)
-        s3_client.put_object(
-            Bucket=S3_BUCKET,
-            Key=json_key,
-            Body=json_body.encode("utf-8"),
-            ContentType="application/json"
-        )
-        logger.info("JSON uploaded to S3: %s", json_key)
+    logger.info("Job completed successfully")
+    return 0
 
-        logger.info("Job completed successfully")
-        sys.exit(0)
+if __name__ == "__main__":
+    # Dump Python stacks if the job dies in native code (torch, Manim, ffmpeg
+    # bindings), where no exception ever reaches the handler below
+    faulthandler.enable()
+    if len(sys.argv) < 2 and not os.getenv("PROMPT"):
+        logger.error("No prompt key provided. Usage: worker.py <prompt_key> [refs_json]")
+        sys.exit(1)
+    try:
+        # The API passes the references it already served as a second
+        # argument; run() only looks them up when it's missing.
+        refs = orjson.loads(sys.argv[2]) if len(sys.argv) > 2 else None
+        sys.exit(run(sys.argv[1] if len(sys.argv) > 1 else None, refs))
     except Exception as e:
-        logger.error("Error in worker script: %s", str(e), exc_info=True)
-        sys.exit(1)
\ No newline at end of file
+        # One failure per process at most, so the traceback is always worth it
+        logger.error("Error in worker script: %s: %s", type(e).__name__, e, exc_info=True)
+        sys.exit(1)